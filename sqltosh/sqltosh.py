@@ -4,18 +4,96 @@ SQLtoSH is an sql interpreter for browsing and manipulating files/structure in a
 
 import sys
 import platform
-import re
 import time
-import math
 
 # Rich is a 3rd party library for displaying 'rich' text in the terminal.
 from rich.console import Console
 from rich.table import Table
 from rich import box
-from os import path, walk, scandir, system
+from os import path, walk, scandir
 from pwd import getpwuid
 from grp import getgrgid
 from operator import itemgetter
+from functools import lru_cache
+from math import floor
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Display values for the 'type' column
+FILE_TYPE = ':spiral_notepad:  file'
+DIRECTORY_TYPE = ':open_file_folder: directory'
+UNKNOWN_TYPE = ':question: Unknown'
+
+# Row styles for each type
+FILE_STYLE = 'bold green'
+DIRECTORY_STYLE = 'bold blue'
+UNKNOWN_STYLE = 'bold yellow'
+
+# Format used for the created_on / last_modified / last_accessed columns
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Units used for the file_size column
+SIZE_NAMES = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+
+# rwx representation of each octal permission digit, indexed by the digit's value
+PERMISSIONS = ('---', '--x', '-w-', '-wx', 'r--', 'r-x', 'rw-', 'rwx')
+
+# Most rows select will render, larger results are truncated
+MAX_ROWS = 10_000
+
+# Directories with at least this many entries are scanned on a thread pool, in slices of
+# SCAN_CHUNK_SIZE entries per task. The work is stat and NSS latency rather than CPU, so the
+# number of threads is not tied to the CPU count
+PARALLEL_SCAN_THRESHOLD = 256
+SCAN_CHUNK_SIZE = 64
+SCAN_WORKERS = 8
+
+# Words the tokenizer reports as keywords rather than identifiers
+KEYWORDS = frozenset(['from', 'where'])
+
+
+def tokenize(query):
+    """ Splits a query on whitespace into (kind, value) tokens
+
+    kind is the lowercased keyword for the words in KEYWORDS and 'identifier' for everything
+    else, value is the word as typed. Commas are left in place, only the column list treats
+    them as separators.
+    """
+    tokens = []
+
+    for word in query.split():
+        lowered = word.lower()
+        tokens.append((lowered if lowered in KEYWORDS else 'identifier', word))
+
+    return tokens
+
+
+@lru_cache(maxsize=None)
+def owner_name(uid):
+    """ Resolve a uid to its user name, caching the lookup
+    """
+    try:
+        return getpwuid(uid).pw_name
+    except KeyError:
+        return 'Unknown'
+
+
+@lru_cache(maxsize=None)
+def group_name(gid):
+    """ Resolve a gid to its group name, caching the lookup
+    """
+    try:
+        return getgrgid(gid).gr_name
+    except KeyError:
+        return 'Unknown'
+
+
+@lru_cache(maxsize=4096)
+def format_epoch(epoch):
+    """ Format a whole-second epoch, caching the result for entries sharing a timestamp
+    """
+    return time.strftime(TIME_FORMAT, time.localtime(epoch))
 
 
 class Prompt():
@@ -36,6 +114,12 @@ class Prompt():
             'owner',
             'group',
             ]
+        self.column_set = frozenset(self.columns)
+        # header and justification of each column in the results table
+        self.column_specs = {
+            col: (col.upper(), "right" if col == 'file_size' else "left")
+            for col in self.columns
+        }
 
         self.statements = {
             'select': self.select,
@@ -53,6 +137,13 @@ class Prompt():
             'exit': 'Exits the session, cleaning up any temporary data',
             'clear': 'Clears the screen',
         }
+        self.command_handlers = {
+            'help': self.help,
+            'exit': self.exit,
+            'clear': self.clear,
+        }
+        # created on the first directory large enough to be scanned in parallel
+        self.scan_pool = None
         self.host_platform = platform.system()
         self.greet()
 
@@ -66,8 +157,8 @@ class Prompt():
             query = input(start_prompt)
 
             # Continue to prompt user until query ends with ;
-            if not re.search(';$', query):
-                while not re.search(';$', query):
+            if not query.endswith(';'):
+                while not query.endswith(';'):
                     query += ' ' + input(newline_prompt)
 
         except (EOFError, KeyboardInterrupt):
@@ -81,35 +172,31 @@ class Prompt():
         """ Executes the query submitted by the user, by routing it to the correct method
         """
 
-        if query in self.commands.keys():
+        if query in self.command_handlers:
             self.command(query)
 
         else:
-            query = query.split()
+            tokens = tokenize(query)
+
+            if not tokens:
+                return
 
-            statement = query[0].lower()
+            statement = tokens[0][1].lower()
 
             if statement in self.statements:
                 try:
                     # Try executing the function associated with the statement
                     # Pass query without the statement ie, remove 'select'
-                    self.statements[statement](query[1:])
+                    self.statements[statement](tokens[1:])
                 except Exception as e:
                     print(e)
 
             else:
-                console.print(f"ERROR 1064 (42000) at line 0: You have an error in your SQL syntax; (Hint): invalid statement: {query[0]}")
+                console.print(f"ERROR 1064 (42000) at line 0: You have an error in your SQL syntax; (Hint): invalid statement: {tokens[0][1]}")
             
 
     def command(self, query):
-        if query == 'help':
-            self.help()
-
-        elif query == 'exit':
-            self.exit()
-        
-        elif query == 'clear':
-            self.clear()
+        self.command_handlers[query]()
 
 
     def help(self):
@@ -124,15 +211,16 @@ class Prompt():
 
     def exit(self):
         # add any necessary cleanup
+        if self.scan_pool is not None:
+            self.scan_pool.shutdown(wait=False)
+
         console.print("Goodbye.")
         sys.exit(0)
 
 
     def clear(self):
-        try:
-            system('clear')
-        except Exception:
-            pass
+        # Rich writes the escape codes directly rather than spawning clear(1)
+        console.clear()
 
 
     def supported_platform(self):
@@ -158,31 +246,35 @@ class Prompt():
         returns a structured table containing the search results
         """
 
-        columns = self.columns if query[0] == '*' else []
-
-        if not columns:
-            for counter, q in enumerate(query, start=1):
-                if q.lower() == 'from':
-                    query = query[counter:]
-                    break
-                
-                if re.search(',$', q):
-                    q = q[:-1]
-
-                if q not in self.columns:
-                    console.print(f"ERROR 1054 (42S22) at line 0: Unknown column '{q}' in 'field list'")
-                    return False
-                else:
-                    columns.append(q)
-        else:
-            # remove * and from
-            query = query[2:]
-        
-        try:
-            directory = query[0]
-            # Remove the directory name from the query
-            query = query[1:]
-        except IndexError:
+        columns = []
+        directory = None
+        state = 'columns'
+
+        for counter, (kind, value) in enumerate(query, start=1):
+            if state == 'columns':
+                if kind == 'from':
+                    state = 'directory'
+                    continue
+
+                for col in value.split(','):
+                    if not col:
+                        continue
+                    elif col == '*':
+                        columns.extend(self.columns)
+                    elif col not in self.column_set:
+                        console.print(f"ERROR 1054 (42S22) at line 0: Unknown column '{col}' in 'field list'")
+                        return False
+                    else:
+                        columns.append(col)
+
+            else:
+                # whatever follows FROM is the directory, even if it reads like a keyword
+                directory = value
+                # Remove the directory name from the query
+                query = query[counter:]
+                break
+
+        if directory is None:
             console.print(f"ERROR 1064 (42000) at line 0: You have an error in your SQL syntax; (Hint): missing directory / path")
             return False
 
@@ -190,33 +282,59 @@ class Prompt():
         #     self.execute(query)
 
 
+        files = self.get_files(directory)
+
+        if files is False:
+            return False
+
+        if not files:
+            console.print("Empty set (0.00 sec)\n")
+            return
+
+        self.sort_data(files, 'name')
+
+        # only hand rich as many rows as are worth rendering
+        shown = files[:MAX_ROWS]
+
         table = Table(title=f"{directory}", show_header=True, header_style=self.header_color, box=box.SQUARE)
         table.add_column('', justify="right")
         for col in columns:
-            table.add_column(col.upper(), justify="right" if col == 'file_size' else "left")
-
-        files = self.get_files(directory)
+            header, justify = self.column_specs[col]
+            table.add_column(header, justify=justify)
 
-        if not files:
-            return False
+        # itemgetter only returns a tuple when given more than one key
+        if len(columns) > 1:
+            project = itemgetter(*columns)
+        elif columns:
+            col = columns[0]
 
-        files = self.sort_data(files, 'name')
+            def project(f):
+                return (f[col],)
+        else:
+            # 'select from dir' selects no columns, only the row counter is shown
+            def project(f):
+                return ()
 
-        for counter, f in enumerate(files):
+        for counter, f in enumerate(shown):
             table.add_row(str(counter), 
-                *[(f[x]) for x in columns],
-                style = 'bold blue' if 'directory' in f['type'] else 'bold green' if 'file' in f['type'] else 'bold yellow',
+                *project(f),
+                style = f['_style'],
             )
 
         console.print(table)
-        console.print(f"{len(files)} rows in set (0.00 sec)")
-        print()
+        if len(shown) < len(files):
+            console.print(f"{len(shown)} of {len(files)} rows in set (0.00 sec)\n")
+        else:
+            console.print(f"{len(files)} rows in set (0.00 sec)\n")
         
 
     def sort_data(self, data, key, desc=None):
-        """ Sort a list of dictionaries by key
+        """ Sort a list of dictionaries by key, in place
+
+        returns the same list for convenience
         """
-        return sorted(data, key=itemgetter(key), reverse=True if desc else False)
+        data.sort(key=itemgetter(key), reverse=bool(desc))
+        return data
 
 
 
@@ -238,90 +356,112 @@ class Prompt():
             return False
         
         # get all files in the path
-        files = []
+        return self.scan_files(directory)
+
+    def scan_files(self, directory):
+        """ Returns a list with a row for each entry in directory
+
+        The full listing is always built, select sorts it before anything is shown. Large
+        directories are stat'd on a thread pool so the stat and user/group lookups overlap
+        """
 
+        # bind the converters locally, they are called for every entry
+        convert_epoch = self.convert_epoch
+        convert_size = self.convert_size
+        convert_unix_permissions = self.convert_unix_permissions
+
+        def scan_entry(entry):
+            # DirEntry caches these, so each is resolved at most once per entry
+            if entry.is_file():
+                file_type, style = FILE_TYPE, FILE_STYLE
+            elif entry.is_dir():
+                file_type, style = DIRECTORY_TYPE, DIRECTORY_STYLE
+            else:
+                file_type, style = UNKNOWN_TYPE, UNKNOWN_STYLE
+
+            try:
+                file_stat = entry.stat()
+
+                return {
+                    'name': entry.name,
+                    'type': file_type,
+                    '_style': style,
+                    'created_on': convert_epoch(file_stat.st_ctime),
+                    'last_modified': convert_epoch(file_stat.st_mtime),
+                    'last_accessed': convert_epoch(file_stat.st_atime),
+                    'file_size': convert_size(file_stat.st_size),
+                    'permissions': convert_unix_permissions(file_stat.st_mode),
+                    'owner': owner_name(file_stat.st_uid),
+                    'group': group_name(file_stat.st_gid),
+                }
+            except FileNotFoundError:
+                return {
+                    'name': entry.name,
+                    'type': file_type,
+                    '_style': style,
+                    'created_on': 'Unknown',
+                    'last_modified': 'Unknown',
+                    'last_accessed': 'Unknown',
+                    'file_size': 'Unknown',
+                    'permissions': 'Unknown',
+                    'owner': 'Unknown',
+                    'group': 'Unknown',
+                }
 
         with scandir(directory) as dir_contents:
-            for entry in dir_contents:
-                try:
-                    file_stat = entry.stat()
-
-                    try:
-                        owner = getpwuid(file_stat.st_uid).pw_name
-                    except:
-                        owner = 'Unknown'
-
-                    try:
-                        group = getgrgid(file_stat.st_gid).gr_name
-                    except:
-                        group = "Unknown"
-
-                    files.append({
-                        'name': entry.name,
-                        'type': ':spiral_notepad:  file' if entry.is_file() else ':open_file_folder: directory' if entry.is_dir() else ':question: Unknown',
-                        'created_on': self.convert_epoch(file_stat.st_ctime),
-                        'last_modified': self.convert_epoch(file_stat.st_mtime),
-                        'last_accessed': self.convert_epoch(file_stat.st_atime),
-                        'file_size': self.convert_size(file_stat.st_size),
-                        'permissions': self.convert_unix_permissions(str(oct(file_stat.st_mode))[-3:]),
-                        'owner': owner,
-                        'group': group,
-                    })
-                except FileNotFoundError:
-                    files.append({
-                        'name': entry.name,
-                        'type': ':spiral_notepad:  file' if entry.is_file() else ':open_file_folder: directory' if entry.is_dir() else ':question: Unknown',
-                        'created_on': 'Unknown',
-                        'last_modified': 'Unknown',
-                        'last_accessed': 'Unknown',
-                        'file_size': 'Unknown',
-                        'permissions': 'Unknown',
-                        'owner': 'Unknown',
-                        'group': 'Unknown',
-                    })
+            # only hold on to the entries themselves when there are enough to hand to the pool,
+            # below the threshold the thread handoff costs more than it saves
+            entries = list(islice(dir_contents, PARALLEL_SCAN_THRESHOLD))
+            if len(entries) < PARALLEL_SCAN_THRESHOLD:
+                return [scan_entry(entry) for entry in entries]
 
+            entries.extend(dir_contents)
 
-        return files
+        chunks = [entries[i:i + SCAN_CHUNK_SIZE] for i in range(0, len(entries), SCAN_CHUNK_SIZE)]
 
-    def convert_unix_permissions(self, mode):
-        permissions = {
-            '7': 'rwx',
-            '6': 'rw-',
-            '5': 'r-x',
-            '4': 'r--',
-            '3': '-wx',
-            '2': '-w-',
-            '1': '--x',
-            '0': '---',
-        }
-        
+        # with a single worker the pool would only add dispatch overhead
+        if min(SCAN_WORKERS, len(chunks)) < 2:
+            return [scan_entry(entry) for entry in entries]
+
+        def scan_chunk(chunk):
+            return [scan_entry(entry) for entry in chunk]
+
+        if self.scan_pool is None:
+            self.scan_pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
 
-        perms = ''
-        for n in mode:
-            perms += permissions[n]
+        files = []
+        for rows in self.scan_pool.map(scan_chunk, chunks):
+            files.extend(rows)
+
+        return files
 
-        return perms
+    def convert_unix_permissions(self, mode):
+        # owner, group and other are the three low octal digits of st_mode
+        return PERMISSIONS[(mode >> 6) & 7] + PERMISSIONS[(mode >> 3) & 7] + PERMISSIONS[mode & 7]
             
     def convert_size(self, size_bytes):
         if size_bytes == 0:
             return "0B"
-        size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-        i = int(math.floor(math.log(size_bytes, 1024)))
-        p = math.pow(1024, i)
-        s = round(size_bytes / p, 2)
-        return "%s %s" % (s, size_name[i])
+        # each unit is 2**10 larger than the last, so the bit length gives the unit directly
+        i = min((size_bytes.bit_length() - 1) // 10, len(SIZE_NAMES) - 1)
+        s = round(size_bytes / (1 << (10 * i)), 2)
+        return f"{s} {SIZE_NAMES[i]}"
 
     def where(self):
         pass
 
     def convert_epoch(self, epoch):
-        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(epoch))
+        # localtime drops the fraction anyway, flooring keeps the cache keys whole seconds
+        return format_epoch(floor(epoch))
 
     def greet(self):
-        console.print('\n' + "Welcome to the sqltosh monitor :desktop_computer: . Commands end with [bold magenta];[/bold magenta].")
-        console.print("Server version: [bold magenta]1.0.0a[/bold magenta] SqltoSH Server (MIT)")
-        console.print("\n")
-        console.print("Type 'help;' for help." + '\n')
+        console.print(
+            '\n'
+            "Welcome to the sqltosh monitor :desktop_computer: . Commands end with [bold magenta];[/bold magenta].\n"
+            "Server version: [bold magenta]1.0.0a[/bold magenta] SqltoSH Server (MIT)\n"
+            "\n\n"
+            "Type 'help;' for help.\n"
+        )
 
 
 if __name__ == '__main__':